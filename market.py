@@ -1,117 +1,119 @@
+import asyncio
 import datetime
 import logging.config
+from itertools import chain, repeat
 
+import orjson
 import requests
 from environs import Env
 
-from seller import divide, price_conversion
-from seller import download_stock
+from seller import TIMEOUT, ApiClient, divide, price_conversion
+from seller import download_stock, stock_conversion, upload_batches
 
 logger = logging.getLogger(__file__)
 
 
-def get_product_list(page, campaign_id, access_token):
-    """Получает список товаров из Яндекс Маркета.
+class MarketClient(ApiClient):
+    """Клиент API Яндекс Маркета для одной кампании.
 
         Args:
-            page (str): Токен страницы для пагинации.
             campaign_id (str): ID кампании в Яндекс Маркете.
             access_token (str): Токен авторизации API.
-
-        Returns:
-            dict: Результат запроса с товарами.
     """
+
     endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
-    payload = {
-        "page_token": page,
-        "limit": 200,
-    }
-    url = endpoint_url + f"campaigns/{campaign_id}/offer-mapping-entries"
-    response = requests.get(url, headers=headers, params=payload)
-    response.raise_for_status()
-    response_object = response.json()
-    return response_object.get("result")
-
-
-def update_stocks(stocks, campaign_id, access_token):
-    """Обновляет остатки товаров в Яндекс Маркете.
 
-        Args:
-            stocks (list): Список остатков товаров.
-            campaign_id (str): ID кампании в Яндекс Маркете.
-            access_token (str): Токен авторизации API.
+    def __init__(self, campaign_id, access_token):
+        super().__init__(
+            {
+                "Authorization": f"Bearer {access_token}",
+                "Accept": "application/json",
+                "Host": "api.partner.market.yandex.ru",
+            }
+        )
+        self.campaign_url = self.endpoint_url + f"campaigns/{campaign_id}/"
 
-        Returns:
-            dict: Ответ API.
-    """
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
-    payload = {"skus": stocks}
-    url = endpoint_url + f"campaigns/{campaign_id}/offers/stocks"
-    response = requests.put(url, headers=headers, json=payload)
-    response.raise_for_status()
-    response_object = response.json()
-    return response_object
-
-
-def update_price(prices, campaign_id, access_token):
-    """Обновляет цены товаров в Яндекс Маркете.
+    def get_product_list(self, page):
+        """Получает список товаров из Яндекс Маркета.
 
-        Args:
-            prices (list): Список цен товаров.
-            campaign_id (str): ID кампании в Яндекс Маркете.
-            access_token (str): Токен авторизации API.
+            Args:
+                page (str): Токен страницы для пагинации.
 
-        Returns:
-            dict: Ответ API.
-    """
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
-    payload = {"offers": prices}
-    url = endpoint_url + f"campaigns/{campaign_id}/offer-prices/updates"
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    response_object = response.json()
-    return response_object
-
-
-def get_offer_ids(campaign_id, market_token):
+            Returns:
+                dict: Результат запроса с товарами.
+        """
+        payload = {
+            "page_token": page,
+            "limit": 200,
+        }
+        response = self.session.get(
+            self.campaign_url + "offer-mapping-entries",
+            params=payload,
+            timeout=TIMEOUT,
+        )
+        response.raise_for_status()
+        response_object = orjson.loads(response.content)
+        return response_object.get("result")
+
+    def update_stocks(self, stocks):
+        """Обновляет остатки товаров в Яндекс Маркете.
+
+            Args:
+                stocks (list): Список остатков товаров.
+
+            Returns:
+                dict: Ответ API.
+        """
+        payload = {"skus": stocks}
+        response = self.session.put(
+            self.campaign_url + "offers/stocks",
+            data=orjson.dumps(payload),
+            timeout=TIMEOUT,
+        )
+        response.raise_for_status()
+        response_object = orjson.loads(response.content)
+        return response_object
+
+    def update_price(self, prices):
+        """Обновляет цены товаров в Яндекс Маркете.
+
+            Args:
+                prices (list): Список цен товаров.
+
+            Returns:
+                dict: Ответ API.
+        """
+        payload = {"offers": prices}
+        response = self.session.post(
+            self.campaign_url + "offer-prices/updates",
+            data=orjson.dumps(payload),
+            timeout=TIMEOUT,
+        )
+        response.raise_for_status()
+        response_object = orjson.loads(response.content)
+        return response_object
+
+
+def get_offer_ids(client):
     """Получить артикулы товаров Яндекс маркета.
 
         Args:
-            campaign_id (str): ID кампании в Яндекс Маркете.
-            market_token (str): Токен авторизации API.
+            client (MarketClient): Клиент API кампании.
 
         Returns:
-            list: Список артикулов товаров.
+            set: Множество артикулов товаров.
     """
-    page = ""
-    product_list = []
-    while True:
-        some_prod = get_product_list(page, campaign_id, market_token)
-        product_list.extend(some_prod.get("offerMappingEntries"))
+    offer_ids = set()
+    request = client.executor.submit(client.get_product_list, "")
+    while request:
+        some_prod = request.result()
         page = some_prod.get("paging").get("nextPageToken")
-        if not page:
-            break
-    offer_ids = []
-    for product in product_list:
-        offer_ids.append(product.get("offer").get("shopSku"))
+        # Запросим следующую страницу, пока разбираем текущую
+        request = None
+        if page:
+            request = client.executor.submit(client.get_product_list, page)
+        for product in some_prod.get("offerMappingEntries"):
+            offer_ids.add(product.get("offer").get("shopSku"))
     return offer_ids
 
 
@@ -119,54 +121,36 @@ def create_stocks(watch_remnants, offer_ids, warehouse_id):
     """Создаёт список остатков товаров для загрузки в Маркет.
 
     Args:
-        watch_remnants (list): Остатки товаров.
-        offer_ids (list): Артикулы товаров.
+        watch_remnants (pandas.DataFrame): Остатки товаров.
+        offer_ids (set): Артикулы товаров.
         warehouse_id (str): ID склада.
 
     Returns:
         list: Список остатков товаров в формате API Маркета.
     """
-    # Уберем то, что не загружено в market
-    stocks = list()
-    date = str(datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z")
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
-            stocks.append(
-                {
-                    "sku": str(watch.get("Код")),
-                    "warehouseId": warehouse_id,
-                    "items": [
-                        {
-                            "count": stock,
-                            "type": "FIT",
-                            "updatedAt": date,
-                        }
-                    ],
-                }
-            )
-            offer_ids.remove(str(watch.get("Код")))
+    # Уберем то, что не загружено в market, и повторы артикулов
+    codes = watch_remnants["Код"]
+    found = codes.isin(offer_ids) & ~codes.duplicated()
+    found_stocks = stock_conversion(watch_remnants.loc[found, "Количество"])
+    found_codes = codes[found].tolist()
     # Добавим недостающее из загруженного:
-    for offer_id in offer_ids:
-        stocks.append(
-            {
-                "sku": offer_id,
-                "warehouseId": warehouse_id,
-                "items": [
-                    {
-                        "count": 0,
-                        "type": "FIT",
-                        "updatedAt": date,
-                    }
-                ],
-            }
+    missing_codes = offer_ids.difference(found_codes)
+    date = (
+        datetime.datetime.now(datetime.timezone.utc)
+        .isoformat(timespec="seconds")
+        .replace("+00:00", "Z")
+    )
+    stocks = [
+        {
+            "sku": code,
+            "warehouseId": warehouse_id,
+            "items": [{"count": stock, "type": "FIT", "updatedAt": date}],
+        }
+        for code, stock in chain(
+            zip(found_codes, found_stocks.tolist()),
+            zip(missing_codes, repeat(0)),
         )
+    ]
     return stocks
 
 
@@ -174,85 +158,88 @@ def create_prices(watch_remnants, offer_ids):
     """Создаёт список цен для загрузки в Маркет.
 
         Args:
-            watch_remnants (list): Остатки товаров.
-            offer_ids (list): Артикулы товаров.
+            watch_remnants (pandas.DataFrame): Остатки товаров.
+            offer_ids (set): Артикулы товаров.
 
         Returns:
             list: Список цен в формате API Маркета.
     """
+    codes = watch_remnants["Код"]
+    found = codes.isin(offer_ids)
+    values = watch_remnants.loc[found, "Цена"].map(price_conversion).astype(int)
     prices = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
-                "id": str(watch.get("Код")),
-                # "feed": {"id": 0},
-                "price": {
-                    "value": int(price_conversion(watch.get("Цена"))),
-                    # "discountBase": 0,
-                    "currencyId": "RUR",
-                    # "vat": 0,
-                },
-                # "marketSku": 0,
-                # "shopSku": "string",
-            }
-            prices.append(price)
+    for code, value in zip(codes[found].tolist(), values.tolist()):
+        price = {
+            "id": code,
+            # "feed": {"id": 0},
+            "price": {
+                "value": value,
+                # "discountBase": 0,
+                "currencyId": "RUR",
+                # "vat": 0,
+            },
+            # "marketSku": 0,
+            # "shopSku": "string",
+        }
+        prices.append(price)
     return prices
 
 
-async def upload_prices(watch_remnants, campaign_id, market_token):
+async def upload_prices(watch_remnants, client, offer_ids=None):
     """
         Загрузка цен для предложений в кампанию.
 
         Эта функция получает идентификаторы предложений для указанной кампании,
-        затем создает и обновляет цены для предложений в этой кампании, отправляя
-        данные пакетами по 500 предложений.
+        если они не переданы, затем создает и обновляет цены для предложений
+        в этой кампании, параллельно отправляя данные пакетами по 500 предложений.
 
         Args:
-            watch_remnants (list): Список остатков, который содержит данные для обновления цен.
-            campaign_id (str): Идентификатор кампании, для которой обновляются цены.
-            market_token (str): Токен для доступа к маркетплейсу, необходим для обновления цен.
+            watch_remnants (pandas.DataFrame): Остатки с данными для обновления цен.
+            client (MarketClient): Клиент API кампании, для которой обновляются цены.
+            offer_ids (set, optional): Уже полученные артикулы товаров кампании.
 
         Return:
             list: Список всех цен, созданных для предложений.
         """
-    offer_ids = get_offer_ids(campaign_id, market_token)
+    if offer_ids is None:
+        offer_ids = await asyncio.to_thread(get_offer_ids, client)
     prices = create_prices(watch_remnants, offer_ids)
-    for some_prices in list(divide(prices, 500)):
-        update_price(some_prices, campaign_id, market_token)
+    await upload_batches(client.executor, client.update_price, divide(prices, 500))
     return prices
 
 
-async def upload_stocks(watch_remnants, campaign_id, market_token, warehouse_id):
+async def upload_stocks(watch_remnants, client, warehouse_id, offer_ids=None):
     """
        Загрузка остатков для предложений в кампанию.
 
        Эта функция получает идентификаторы предложений для указанной кампании,
-       создает и обновляет остатки товаров на складе, отправляя данные пакетами
-       по 2000 предложений. После загрузки остатков возвращает только те остатки,
-       у которых количество товаров не равно нулю.
+       если они не переданы, создает и обновляет остатки товаров на складе,
+       параллельно отправляя данные пакетами по 2000 предложений. После загрузки
+       остатков возвращает только те остатки, у которых количество товаров
+       не равно нулю.
 
        Args:
-           watch_remnants (list): Список остатков, который содержит данные для обновления остатков.
-           campaign_id (str): Идентификатор кампании, для которой обновляются остатки.
-           market_token (str): Токен для доступа к маркетплейсу, необходим для обновления остатков.
+           watch_remnants (pandas.DataFrame): Остатки с данными для обновления остатков.
+           client (MarketClient): Клиент API кампании, для которой обновляются остатки.
            warehouse_id (str): Идентификатор склада, на котором хранятся товары.
+           offer_ids (set, optional): Уже полученные артикулы товаров кампании.
 
        Return:
            tuple:
                - list: Список остатков, в которых количество товаров больше нуля.
                - list: Все остатки товаров для предложений.
        """
-    offer_ids = get_offer_ids(campaign_id, market_token)
+    if offer_ids is None:
+        offer_ids = await asyncio.to_thread(get_offer_ids, client)
     stocks = create_stocks(watch_remnants, offer_ids, warehouse_id)
-    for some_stock in list(divide(stocks, 2000)):
-        update_stocks(some_stock, campaign_id, market_token)
+    await upload_batches(client.executor, client.update_stocks, divide(stocks, 2000))
     not_empty = list(
         filter(lambda stock: (stock.get("items")[0].get("count") != 0), stocks)
     )
     return not_empty, stocks
 
 
-def main():
+async def main():
     env = Env()
     market_token = env.str("MARKET_TOKEN")
     campaign_fbs_id = env.str("FBS_ID")
@@ -261,31 +248,36 @@ def main():
     warehouse_dbs_id = env.str("WAREHOUSE_DBS_ID")
 
     watch_remnants = download_stock()
+    fbs_client = MarketClient(campaign_fbs_id, market_token)
+    dbs_client = MarketClient(campaign_dbs_id, market_token)
     try:
-        # FBS
-        offer_ids = get_offer_ids(campaign_fbs_id, market_token)
-        # Обновить остатки FBS
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_fbs_id)
-        for some_stock in list(divide(stocks, 2000)):
-            update_stocks(some_stock, campaign_fbs_id, market_token)
-        # Поменять цены FBS
-        upload_prices(watch_remnants, campaign_fbs_id, market_token)
-
-        # DBS
-        offer_ids = get_offer_ids(campaign_dbs_id, market_token)
-        # Обновить остатки DBS
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_dbs_id)
-        for some_stock in list(divide(stocks, 2000)):
-            update_stocks(some_stock, campaign_dbs_id, market_token)
-        # Поменять цены DBS
-        upload_prices(watch_remnants, campaign_dbs_id, market_token)
+        # Артикулы каждой кампании запрашиваем один раз
+        fbs_offer_ids, dbs_offer_ids = await asyncio.gather(
+            asyncio.to_thread(get_offer_ids, fbs_client),
+            asyncio.to_thread(get_offer_ids, dbs_client),
+        )
+        await asyncio.gather(
+            # Обновить остатки и цены FBS
+            upload_stocks(
+                watch_remnants, fbs_client, warehouse_fbs_id, fbs_offer_ids
+            ),
+            upload_prices(watch_remnants, fbs_client, fbs_offer_ids),
+            # Обновить остатки и цены DBS
+            upload_stocks(
+                watch_remnants, dbs_client, warehouse_dbs_id, dbs_offer_ids
+            ),
+            upload_prices(watch_remnants, dbs_client, dbs_offer_ids),
+        )
     except requests.exceptions.ReadTimeout:
         print("Превышено время ожидания...")
     except requests.exceptions.ConnectionError as error:
         print(error, "Ошибка соединения")
     except Exception as error:
         print(error, "ERROR_2")
+    finally:
+        fbs_client.close()
+        dbs_client.close()
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
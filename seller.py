@@ -1,128 +1,190 @@
+import asyncio
 import io
 import logging.config
-import os
 import re
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from environs import Env
 
+import orjson
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__file__)
 
+TIMEOUT = (5, 30)
+# Сколько запросов одного клиента выполняется одновременно
+CONCURRENCY = 8
 
-def get_product_list(last_id, client_id, seller_token):
+
+def create_session(pool_maxsize=CONCURRENCY):
+    """Создать сессию с пулом соединений и повтором неудачных запросов"""
+    session = requests.Session()
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=pool_maxsize,
+            # Обновления цен и остатков идемпотентны, поэтому повторяем и POST/PUT;
+            # при 429 и 503 выдерживаем паузу из заголовка Retry-After
+            max_retries=Retry(
+                total=5,
+                backoff_factor=0.5,
+                status_forcelist=[429, 502, 503, 504],
+                allowed_methods=["GET", "POST", "PUT"],
+                respect_retry_after_header=True,
+            ),
+        ),
+    )
+    return session
+
+
+class ApiClient:
     """
-       Получить список товаров магазина озон
+        Базовый клиент API маркетплейса.
 
-       Эта функция отправляет запрос к API Озона для получения списка товаров магазина
-       с фильтрацией по видимости (ALL), начиная с переданного last_id и с лимитом 1000 товаров.
+        Хранит сессию с пулом соединений и заголовками, общими для всех
+        запросов, и пул потоков, ограничивающий число одновременных запросов.
+        Каждому потоку достается свое открытое соединение.
 
-       Args:
-           last_id (str): Идентификатор последнего полученного товара, с которого начинать выгрузку.
-           client_id (str): Идентификатор клиента для доступа к API.
-           seller_token (str): Токен для доступа к API магазина.
+        Args:
+            headers (dict): Заголовки авторизации и прочие заголовки клиента.
+        """
 
-       Return:
-           dict: Словарь с результатами запроса, включая список товаров.
-       """
-    url = "https://api-seller.ozon.ru/v2/product/list"
-    headers = {
-        "Client-Id": client_id,
-        "Api-Key": seller_token,
-    }
-    payload = {
-        "filter": {
-            "visibility": "ALL",
-        },
-        "last_id": last_id,
-        "limit": 1000,
-    }
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    response_object = response.json()
-    return response_object.get("result")
-
-
-def get_offer_ids(client_id, seller_token):
+    def __init__(self, headers):
+        self.executor = ThreadPoolExecutor(max_workers=CONCURRENCY)
+        self.session = create_session(pool_maxsize=CONCURRENCY)
+        self.session.headers.update({"Content-Type": "application/json", **headers})
+
+    def close(self):
+        """Дождаться запросов в пуле потоков и закрыть соединения сессии"""
+        self.executor.shutdown()
+        self.session.close()
+
+
+class OzonClient(ApiClient):
     """
-       Получить артикулы товаров магазина озон.
+        Клиент API Озона для одного магазина.
 
-       Эта функция получает список товаров с использованием get_product_list и извлекает
-       все offer_id для каждого товара.
+        Args:
+            client_id (str): Идентификатор клиента для доступа к API.
+            seller_token (str): Токен для доступа к API магазина.
+        """
 
-       Args:
-           client_id (str): Идентификатор клиента для доступа к API.
-           seller_token (str): Токен для доступа к API магазина.
+    endpoint_url = "https://api-seller.ozon.ru/"
 
-       Return:
-           list: Список артикулов (offer_id) товаров.
-       """
-    last_id = ""
-    product_list = []
-    while True:
-        some_prod = get_product_list(last_id, client_id, seller_token)
-        product_list.extend(some_prod.get("items"))
-        total = some_prod.get("total")
-        last_id = some_prod.get("last_id")
-        if total == len(product_list):
-            break
-    offer_ids = []
-    for product in product_list:
-        offer_ids.append(product.get("offer_id"))
-    return offer_ids
+    def __init__(self, client_id, seller_token):
+        super().__init__({"Client-Id": client_id, "Api-Key": seller_token})
 
+    def get_product_list(self, last_id):
+        """
+           Получить список товаров магазина озон
+
+           Эта функция отправляет запрос к API Озона для получения списка товаров
+           магазина с фильтрацией по видимости (ALL), начиная с переданного last_id
+           и с лимитом 1000 товаров.
+
+           Args:
+               last_id (str): Идентификатор последнего полученного товара,
+                   с которого начинать выгрузку.
+
+           Return:
+               dict: Словарь с результатами запроса, включая список товаров.
+           """
+        payload = {
+            "filter": {
+                "visibility": "ALL",
+            },
+            "last_id": last_id,
+            "limit": 1000,
+        }
+        response = self.session.post(
+            self.endpoint_url + "v2/product/list", json=payload, timeout=TIMEOUT
+        )
+        response.raise_for_status()
+        response_object = orjson.loads(response.content)
+        return response_object.get("result")
+
+    def update_price(self, prices: list):
+        """
+           Обновить цены товаров.
+
+           Эта функция отправляет запрос к API Озона для обновления цен товаров,
+           переданных в списке prices.
+
+           Args:
+               prices (list): Список словарей с информацией о ценах товаров.
+
+           Return:
+               dict: Ответ от API с результатами обновления цен.
+           """
+        payload = {"prices": prices}
+        response = self.session.post(
+            self.endpoint_url + "v1/product/import/prices",
+            data=orjson.dumps(payload),
+            timeout=TIMEOUT,
+        )
+        response.raise_for_status()
+        return orjson.loads(response.content)
+
+    def update_stocks(self, stocks: list):
+        """
+            Обновить остатки
 
-def update_price(prices: list, client_id, seller_token):
-    """
-       Обновить цены товаров.
+            Эта функция отправляет запрос к API Озона для обновления остатков товаров,
+            переданных в списке stocks.
 
-       Эта функция отправляет запрос к API Озона для обновления цен товаров, переданных
-       в списке prices.
+            Args:
+                stocks (list): Список словарей с информацией об остатках товаров.
 
-       Args:
-           prices (list): Список словарей с информацией о ценах товаров.
-           client_id (str): Идентификатор клиента для доступа к API.
-           seller_token (str): Токен для доступа к API магазина.
+            Return:
+                dict: Ответ от API с результатами обновления остатков.
+            """
+        payload = {"stocks": stocks}
+        response = self.session.post(
+            self.endpoint_url + "v1/product/import/stocks",
+            data=orjson.dumps(payload),
+            timeout=TIMEOUT,
+        )
+        response.raise_for_status()
+        return orjson.loads(response.content)
 
-       Return:
-           dict: Ответ от API с результатами обновления цен.
-       """
-    url = "https://api-seller.ozon.ru/v1/product/import/prices"
-    headers = {
-        "Client-Id": client_id,
-        "Api-Key": seller_token,
-    }
-    payload = {"prices": prices}
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    return response.json()
-
-
-def update_stocks(stocks: list, client_id, seller_token):
+
+def get_offer_ids(client):
     """
-        Обновить остатки
+       Получить артикулы товаров магазина озон.
 
-        Эта функция отправляет запрос к API Озона для обновления остатков товаров,
-        переданных в списке stocks.
+       Эта функция постранично получает список товаров с использованием
+       client.get_product_list и извлекает все offer_id для каждого товара.
+       Следующая страница запрашивается, пока разбирается текущая.
 
-        Args:
-            stocks (list): Список словарей с информацией об остатках товаров.
-            client_id (str): Идентификатор клиента для доступа к API.
-            seller_token (str): Токен для доступа к API магазина.
+       Args:
+           client (OzonClient): Клиент API магазина.
 
-        Return:
-            dict: Ответ от API с результатами обновления остатков.
-        """
-    url = "https://api-seller.ozon.ru/v1/product/import/stocks"
-    headers = {
-        "Client-Id": client_id,
-        "Api-Key": seller_token,
-    }
-    payload = {"stocks": stocks}
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    return response.json()
+       Return:
+           set: Множество артикулов (offer_id) товаров.
+       """
+    offer_ids = set()
+    received = 0
+    request = client.executor.submit(client.get_product_list, "")
+    while request:
+        some_prod = request.result()
+        items = some_prod.get("items")
+        received += len(items)
+        last_id = some_prod.get("last_id")
+        # Запросим следующую страницу, пока разбираем текущую. Курсор
+        # last_id не дает запросить страницы параллельно, а total лишь
+        # подсказывает, когда остановиться: пустая страница или пустой
+        # курсор тоже означают конец списка
+        request = None
+        if items and last_id and received < some_prod.get("total"):
+            request = client.executor.submit(client.get_product_list, last_id)
+        for product in items:
+            offer_ids.add(product.get("offer_id"))
+    return offer_ids
 
 
 def download_stock():
@@ -130,27 +192,33 @@ def download_stock():
        Скачать файл ostatki с сайта casio.
 
         Эта функция скачивает архив с остатками товаров с указанного URL, извлекает
-        файл Excel и возвращает список остатков товаров в виде списка словарей.
+        файл Excel и возвращает остатки товаров в виде таблицы.
 
         Return:
-            list: Список остатков товаров в виде словарей.
+            pandas.DataFrame: Таблица остатков товаров с артикулами
+                в колонке "Код" в виде строк.
         """
     # Скачать остатки с сайта
     casio_url = "https://timeworld.ru/upload/files/ostatki.zip"
-    session = requests.Session()
-    response = session.get(casio_url)
-    response.raise_for_status()
-    with response, zipfile.ZipFile(io.BytesIO(response.content)) as archive:
-        archive.extractall(".")
+    archive_file = io.BytesIO()
+    with create_session() as session, session.get(
+        casio_url, stream=True, timeout=TIMEOUT
+    ) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            archive_file.write(chunk)
+    # Распакуем остатки в память, минуя диск
+    with zipfile.ZipFile(archive_file) as archive:
+        excel_file = io.BytesIO(archive.read("ostatki.xls"))
     # Создаем список остатков часов:
-    excel_file = "ostatki.xls"
     watch_remnants = pd.read_excel(
         io=excel_file,
         na_values=None,
         keep_default_na=False,
         header=17,
-    ).to_dict(orient="records")
-    os.remove("./ostatki.xls")  # Удалить файл
+    )
+    # Артикулы сравниваются со строковыми offer_id, приведем их один раз
+    watch_remnants["Код"] = watch_remnants["Код"].astype(str)
     return watch_remnants
 
 
@@ -162,27 +230,23 @@ def create_stocks(watch_remnants, offer_ids):
         с доступными offer_ids. Если остаток не найден, для товара будет установлен остаток 0.
 
         Args:
-            watch_remnants (list): Список данных об остатках товаров.
-            offer_ids (list): Список offer_id товаров, доступных в магазине.
+            watch_remnants (pandas.DataFrame): Таблица данных об остатках товаров.
+            offer_ids (set): Множество offer_id товаров, доступных в магазине.
 
         Return:
             list: Список словарей с информацией об остатках товаров.
         """
-    # Уберем то, что не загружено в seller
-    stocks = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
-            stocks.append({"offer_id": str(watch.get("Код")), "stock": stock})
-            offer_ids.remove(str(watch.get("Код")))
+    # Уберем то, что не загружено в seller, и повторы артикулов
+    codes = watch_remnants["Код"]
+    found = codes.isin(offer_ids) & ~codes.duplicated()
+    found_stocks = stock_conversion(watch_remnants.loc[found, "Количество"])
+    found_codes = codes[found].tolist()
+    stocks = [
+        {"offer_id": code, "stock": stock}
+        for code, stock in zip(found_codes, found_stocks.tolist())
+    ]
     # Добавим недостающее из загруженного:
-    for offer_id in offer_ids:
+    for offer_id in offer_ids.difference(found_codes):
         stocks.append({"offer_id": offer_id, "stock": 0})
     return stocks
 
@@ -195,106 +259,141 @@ def create_prices(watch_remnants, offer_ids):
         с доступными offer_ids и преобразуя цену в нужный формат.
 
         Args:
-            watch_remnants (list): Список данных о товарах и их ценах.
-            offer_ids (list): Список offer_id товаров, доступных в магазине.
+            watch_remnants (pandas.DataFrame): Таблица данных о товарах и их ценах.
+            offer_ids (set): Множество offer_id товаров, доступных в магазине.
 
         Return:
             list: Список словарей с информацией о ценах товаров.
         """
+    codes = watch_remnants["Код"]
+    found = codes.isin(offer_ids)
+    values = watch_remnants.loc[found, "Цена"].map(price_conversion)
     prices = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
-                "auto_action_enabled": "UNKNOWN",
-                "currency_code": "RUB",
-                "offer_id": str(watch.get("Код")),
-                "old_price": "0",
-                "price": price_conversion(watch.get("Цена")),
-            }
-            prices.append(price)
+    for code, value in zip(codes[found].tolist(), values.tolist()):
+        price = {
+            "auto_action_enabled": "UNKNOWN",
+            "currency_code": "RUB",
+            "offer_id": code,
+            "old_price": "0",
+            "price": value,
+        }
+        prices.append(price)
     return prices
 
 
+_NON_DIGITS = re.compile("[^0-9]")
+
+
 def price_conversion(price: str) -> str:
     """Преобразовать цену. Пример: 5'990.00 руб. -> 5990"""
-    return re.sub("[^0-9]", "", price.split(".")[0])
+    if not price:
+        return ""
+    return _NON_DIGITS.sub("", str(price).split(".", 1)[0])
+
+
+_STOCK_MAP = {">10": 100, "1": 0}
+
+
+def stock_conversion(counts: pd.Series) -> pd.Series:
+    """Преобразовать остатки. Пример: >10 -> 100, 1 -> 0, 5 -> 5"""
+    counts = counts.astype(str)
+    numeric = pd.to_numeric(counts, errors="coerce")
+    return counts.map(_STOCK_MAP).fillna(numeric).fillna(0).astype(int)
+
+
+def divide(items, n: int):
+    """Лениво разделить последовательность items на части по n элементов"""
+    items = iter(items)
+    while batch := list(islice(items, n)):
+        yield batch
 
 
-def divide(lst: list, n: int):
-    """Разделить список lst на части по n элементов"""
-    for i in range(0, len(lst), n):
-        yield lst[i : i + n]
+async def upload_batches(executor, update, batches, *args):
+    """Параллельно отправить пакеты batches через update(batch, *args) в executor"""
+    # Обработчики по очереди забирают пакеты из общего итератора,
+    # поэтому следующий пакет формируется только когда его есть кому отправить.
+    # Одновременно выполняется не больше запросов, чем потоков в executor
+    loop = asyncio.get_running_loop()
+    batches = iter(batches)
+    responses = []
 
+    async def upload():
+        for batch in batches:
+            response = await loop.run_in_executor(executor, update, batch, *args)
+            responses.append(response)
 
-async def upload_prices(watch_remnants, client_id, seller_token):
+    await asyncio.gather(*(upload() for _ in range(CONCURRENCY)))
+    return responses
+
+
+async def upload_prices(watch_remnants, client, offer_ids=None):
     """
         Асинхронная загрузка цен для товаров.
 
         Эта функция асинхронно отправляет запросы для обновления цен товаров,
-        разбивая их на пакеты по 1000 элементов.
+        разбивая их на пакеты по 1000 элементов и отправляя пакеты параллельно.
 
         Args:
-            watch_remnants (list): Список остатков товаров для обновления цен.
-            client_id (str): Идентификатор клиента для доступа к API.
-            seller_token (str): Токен для доступа к API магазина.
+            watch_remnants (pandas.DataFrame): Остатки товаров для обновления цен.
+            client (OzonClient): Клиент API магазина.
+            offer_ids (set, optional): Уже полученные артикулы товаров магазина.
 
         Return:
             list: Список словарей с обновленными ценами товаров.
         """
-    offer_ids = get_offer_ids(client_id, seller_token)
+    if offer_ids is None:
+        offer_ids = await asyncio.to_thread(get_offer_ids, client)
     prices = create_prices(watch_remnants, offer_ids)
-    for some_price in list(divide(prices, 1000)):
-        update_price(some_price, client_id, seller_token)
+    await upload_batches(client.executor, client.update_price, divide(prices, 1000))
     return prices
 
 
-async def upload_stocks(watch_remnants, client_id, seller_token):
+async def upload_stocks(watch_remnants, client, offer_ids=None):
     """
         Асинхронная загрузка остатков для товаров.
 
         Эта функция асинхронно отправляет запросы для обновления остатков товаров,
-        разбивая их на пакеты по 100 элементов.
+        разбивая их на пакеты по 100 элементов и отправляя пакеты параллельно.
 
         Args:
-            watch_remnants (list): Список остатков товаров для обновления.
-            client_id (str): Идентификатор клиента для доступа к API.
-            seller_token (str): Токен для доступа к API магазина.
+            watch_remnants (pandas.DataFrame): Остатки товаров для обновления.
+            client (OzonClient): Клиент API магазина.
+            offer_ids (set, optional): Уже полученные артикулы товаров магазина.
 
         Return:
             tuple:
                 - list: Список остатков товаров, где количество больше нуля.
                 - list: Все остатки товаров.
         """
-    offer_ids = get_offer_ids(client_id, seller_token)
+    if offer_ids is None:
+        offer_ids = await asyncio.to_thread(get_offer_ids, client)
     stocks = create_stocks(watch_remnants, offer_ids)
-    for some_stock in list(divide(stocks, 100)):
-        update_stocks(some_stock, client_id, seller_token)
+    await upload_batches(client.executor, client.update_stocks, divide(stocks, 100))
     not_empty = list(filter(lambda stock: (stock.get("stock") != 0), stocks))
     return not_empty, stocks
 
 
-def main():
+async def main():
     env = Env()
     seller_token = env.str("SELLER_TOKEN")
     client_id = env.str("CLIENT_ID")
+    client = OzonClient(client_id, seller_token)
     try:
-        offer_ids = get_offer_ids(client_id, seller_token)
+        offer_ids = get_offer_ids(client)
         watch_remnants = download_stock()
         # Обновить остатки
-        stocks = create_stocks(watch_remnants, offer_ids)
-        for some_stock in list(divide(stocks, 100)):
-            update_stocks(some_stock, client_id, seller_token)
+        await upload_stocks(watch_remnants, client, offer_ids)
         # Поменять цены
-        prices = create_prices(watch_remnants, offer_ids)
-        for some_price in list(divide(prices, 900)):
-            update_price(some_price, client_id, seller_token)
+        await upload_prices(watch_remnants, client, offer_ids)
     except requests.exceptions.ReadTimeout:
         print("Превышено время ожидания...")
     except requests.exceptions.ConnectionError as error:
         print(error, "Ошибка соединения")
     except Exception as error:
         print(error, "ERROR_2")
+    finally:
+        client.close()
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())